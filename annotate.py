@@ -1,22 +1,31 @@
-import atexit
+import argparse
+import asyncio
 import base64
-import re
-import shelve
+import copy
+import json
+import os
 import zipfile
 import shutil
-from concurrent.futures import ThreadPoolExecutor
-from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+import time
+import weakref
+from functools import lru_cache, wraps
 from io import BytesIO
 from textwrap import dedent
 
-from PIL import Image, ImageDraw
-import pngquant
-from openai import OpenAI
-
-client = OpenAI()
+from PIL import Image, ImageDraw, ImageFont
+import diskcache
+from blake3 import blake3
+import orjson
+import tiktoken
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from openai.types.chat import ChatCompletion
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
 from ebooklib import epub
+from lxml import etree
 from pyquery import PyQuery
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from natsort import natsorted
 from pydantic import BaseModel, Field
 from typing import List
@@ -24,36 +33,68 @@ from partial_json_parser import loads as partial_json_loads
 
 
 base_dir = Path(__file__).parent
-cache_file = base_dir / 'cache'
+cache_file = base_dir / 'cache_db'
+
+# maximum number of completion requests in flight at once, across all chapters
+max_concurrency = 50
+# image generation has much lower limits, so it gets its own budget
+max_image_concurrency = 5
+max_image_requests_per_minute = 15
+# account rate limits for the completion model
+max_requests_per_minute = 500
+max_tokens_per_minute = 300_000
+# number of chapters packed into each batched precis request
+precis_batch_size = 8
+
+# font for the cover subtitle, loaded once
+try:
+    FONT = ImageFont.truetype("DejaVuSans-Bold.ttf", 64)
+except OSError:
+    FONT = ImageFont.load_default(size=64)
 
 
 ### caching ###
 
-# Open the shelf
-cache_db = shelve.open(str(cache_file))
+# opened on first use, so worker processes that only import the XML helpers never touch it
+@lru_cache(maxsize=None)
+def get_cache_db():
+    # SQLite-backed, so concurrent reads and writes don't serialize on a single file lock
+    return diskcache.Cache(str(cache_file), size_limit=2**34)
 
 def store_cache(key, value):
+    cache_db = get_cache_db()
+    if key in cache_db:
+        # overwriting a key, so drop any stale in-process copy
+        _get_cache.cache_clear()
     cache_db[key] = value
 
-def get_cache(key):
-    return cache_db.get(key)
+def delete_cache(key):
+    _get_cache.cache_clear()
+    get_cache_db().pop(key, None)
 
-def cleanup_cache():
-    print("Closing the database...")
-    cache_db.close()
+@lru_cache(maxsize=1024)
+def _get_cache(key):
+    # misses raise rather than return None, so lru_cache only remembers hits
+    return get_cache_db()[key]
 
-atexit.register(cleanup_cache)
+def get_cache(key):
+    try:
+        return _get_cache(key)
+    except KeyError:
+        return None
+
+def make_cache_key(name, args, kwargs):
+    # content-addressed, so editing a prompt invalidates its cached result without bumping a version by hand
+    return blake3((name + repr(args) + repr(kwargs)).encode()).hexdigest()
 
 def cached(func):
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        cache_key = kwargs.pop('cache_key', None)
-        if cache_key:
-            if cached := get_cache(cache_key):
-                return cached
-        out = func(*args, **kwargs)
-        if cache_key:
-            store_cache(cache_key, out)
+    async def wrapper(*args, **kwargs):
+        cache_key = kwargs.pop('cache_key', None) or make_cache_key(func.__name__, args, kwargs)
+        if cached := get_cache(cache_key):
+            return cached
+        out = await func(*args, **kwargs)
+        store_cache(cache_key, out)
         return out
     return wrapper
 
@@ -65,27 +106,74 @@ def unpack_epub(epub_path, dest_dir):
         zip_ref.extractall(dest_dir)
 
 
-def pack_epub(source_dir, epub_path):
-    shutil.rmtree(epub_path, ignore_errors=True)
-    # equivalent of `zip -rX ../my.epub mimetype META-INF/ EPUB/`
-    with zipfile.ZipFile(epub_path, 'w') as zipf:
-        zipf.write(source_dir / 'mimetype', 'mimetype', compress_type=zipfile.ZIP_STORED)
-        for path in source_dir.glob('**/*'):
-            if path.relative_to(source_dir) == Path('mimetype'):
-                continue
-            zipf.write(path, path.relative_to(source_dir), compress_type=zipfile.ZIP_DEFLATED)
+class ZipMutator:
+    """
+        Edit an epub in memory: entries are read straight from the input zip, replacements are staged with write(),
+        and save() streams a new zip in the original entry order, so mimetype stays first and stored.
+    """
+    def __init__(self, epub_path):
+        self.zin = zipfile.ZipFile(epub_path, 'r')
+        self.modified_files = {}
+
+    def glob(self, pattern):
+        return [PurePosixPath(name) for name in self.zin.namelist() if fnmatch(name, pattern)]
+
+    def read(self, path):
+        path = str(path)
+        if path in self.modified_files:
+            return self.modified_files[path]
+        return self.zin.read(path)
+
+    def write(self, path, data):
+        if type(data) is str:
+            data = data.encode('utf-8')
+        self.modified_files[str(path)] = data
+
+    def save(self, epub_path, compresslevel=1):
+        # deflate level 1 is several times cheaper than the default 6 and nearly as small; readers don't care
+        with zipfile.ZipFile(epub_path, 'w') as zout:
+            for info in self.zin.infolist():
+                # untouched entries are copied across with their original compression type;
+                # writestr() rewrites offsets and sizes on the ZipInfo it's given, so hand it a copy
+                # and leave the input zip's metadata intact for later reads and saves
+                out_info = copy.copy(info)
+                if info.filename in self.modified_files:
+                    zout.writestr(out_info, self.modified_files[info.filename], compresslevel=compresslevel)
+                else:
+                    zout.writestr(out_info, self.zin.read(info), compresslevel=compresslevel)
+            for name, data in self.modified_files.items():
+                if name not in self.zin.NameToInfo:
+                    zout.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+
+    def close(self):
+        self.zin.close()
 
 def parse_xml(b):
     return PyQuery(b, namespaces=epub.NAMESPACES)
 
-def serialize_xml(pq):
-    return pq.outer_html(method='xml')
+# selectors are compiled to XPath once here rather than translated from CSS on every PyQuery call;
+# PyQuery is only used to wrap the matched elements for mutation
+def compile_xpath(path):
+    return etree.XPath(path, namespaces=epub.NAMESPACES)
+
+SECTION_XPATH = compile_xpath('//XHTML:section')
+# section.html() re-parses the section's children without a namespace, so lookups made after it match on local name
+PARAGRAPH_XPATH = compile_xpath('.//*[local-name()="p"]')
+HEADER_XPATH = compile_xpath('.//*[local-name()="header"]')
+ID_XPATH = compile_xpath('//*[@id=$id]')
+MANIFEST_XPATH = compile_xpath('//OPF:manifest')
+SPINE_XPATH = compile_xpath('//OPF:spine')
+TOC_LIST_XPATH = compile_xpath('//*[@id="toc"]/XHTML:ol')
+
+def dump_xml(pq):
+    # encode straight to utf-8 bytes with the declaration, rather than building and re-encoding a str
+    return etree.tostring(pq[0], encoding='utf-8', xml_declaration=True, method='xml')
 
-def read_xml(path):
-    return parse_xml(path.read_bytes())
+def read_xml(book, path):
+    return parse_xml(book.read(path))
 
-def write_xml(path, pq):
-    path.write_text('<?xml version="1.0" encoding="utf-8"?>\n' + serialize_xml(pq))
+def write_xml(book, path, pq):
+    book.write(path, dump_xml(pq))
 
 ### openai functions ###
 
@@ -121,6 +209,10 @@ class Illustration(BaseModel):
     existing_sentence: str = Field(description="Verbatim text of the existing sentence")
     image_description: str = Field(description="Description of an illustration for the sentence")
 
+class Precis(BaseModel):
+    chapter: int = Field(description="The chapter number, as given in its [CHAPTER n] heading")
+    precis: str = Field(description="The precis for that chapter")
+
 class ReaderAnnotation(BaseModel):
     text: str = Field(description="Verbatim text snippet to annotate")
     annotation: str = Field(description="The annotation text to show for that snippet")
@@ -129,41 +221,207 @@ class ReaderAnnotation(BaseModel):
 dialogue_tool = make_openai_tool_list("dialog", "Process a dialog", Dialogue)
 annotate_tool = make_openai_tool_list("annotate", "Handle list of annotations", Annotation)
 reader_annotate_tool = make_openai_tool_list("annotate", "Handle list of annotations", ReaderAnnotation)
-addition_tool = make_openai_tool("addition", "Handle new sentence", Addition)
+addition_tool = make_openai_tool_list("addition", "Handle list of new sentences", Addition)
 illustration_tool = make_openai_tool("illustration", "Generate illustration", Illustration)
+precis_tool = make_openai_tool_list("precis", "Handle list of chapter precis", Precis)
 
-@cached
-def get_completion_text(prompt, tool=None, **kwargs):
+class RateLimiter:
+    """
+        Leaky-bucket request and token budgets, after openai-cookbook's api_request_parallel_processor.py.
+        Capacity refills continuously, and acquire() waits until there's room for the whole request.
+        Pass max_tokens_per_minute=None to only limit requests.
+    """
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute=None):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+
+    def update_capacity(self):
+        now = time.monotonic()
+        seconds_since_update = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + seconds_since_update * self.max_requests_per_minute / 60,
+            self.max_requests_per_minute,
+        )
+        if self.max_tokens_per_minute is not None:
+            self.available_token_capacity = min(
+                self.available_token_capacity + seconds_since_update * self.max_tokens_per_minute / 60,
+                self.max_tokens_per_minute,
+            )
+        self.last_update_time = now
+
+    async def acquire(self, tokens=0):
+        if self.max_tokens_per_minute is None:
+            tokens = 0
+        else:
+            # a request bigger than the whole bucket would otherwise wait forever
+            tokens = min(tokens, self.max_tokens_per_minute)
+        while True:
+            self.update_capacity()
+            if self.available_request_capacity >= 1 and (tokens == 0 or self.available_token_capacity >= tokens):
+                self.available_request_capacity -= 1
+                if tokens:
+                    self.available_token_capacity -= tokens
+                return
+            await asyncio.sleep(0.001)
+
+# loaded on first use; encoding_for_model() may download the BPE file
+@lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.encoding_for_model("gpt-4")
+
+def estimate_tokens(prompt, max_tokens=500, n=1, system=None, **kwargs):
+    encoding = get_encoding()
+    prompt_tokens = len(encoding.encode(prompt)) + (len(encoding.encode(system)) if system else 0)
+    return prompt_tokens + max_tokens * n
+
+class RequestLimits:
+    """
+        Concurrency and rate limits shared by every request in a run, so they apply globally rather than per chapter.
+    """
+    def __init__(self):
+        self.text_sem = asyncio.Semaphore(max_concurrency)
+        self.limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+        self.image_sem = asyncio.Semaphore(max_image_concurrency)
+        self.image_limiter = RateLimiter(max_image_requests_per_minute)
+
+# asyncio semaphores bind to the first event loop that waits on them, so each loop (i.e. each asyncio.run()) gets its own
+_request_limits = weakref.WeakKeyDictionary()
+
+def get_request_limits():
+    loop = asyncio.get_running_loop()
+    if loop not in _request_limits:
+        _request_limits[loop] = RequestLimits()
+    return _request_limits[loop]
+
+@lru_cache(maxsize=None)
+def get_client():
+    # retries are handled by retry_openai below, so each attempt goes back through the rate limiter
+    return AsyncOpenAI(max_retries=0)
+
+# retry transient API failures; applied to the raw calls so results are still cached after a retry,
+# and so every attempt takes its own slot and rate-limiter capacity
+retry_openai = retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)),
+    # surface the last OpenAI error rather than tenacity's RetryError
+    reraise=True,
+)
+
+@retry_openai
+async def call_openai(method, *args, **kwargs):
+    # for calls outside the rate limiters, such as the Batch API endpoints, which the client no longer retries itself
+    return await method(*args, **kwargs)
+
+@retry_openai
+async def create_chat_completion(tokens, **kwargs):
+    limits = get_request_limits()
+    async with limits.text_sem:
+        await limits.limiter.acquire(tokens)
+        return await get_client().chat.completions.create(**kwargs)
+
+@retry_openai
+async def create_image(**kwargs):
+    limits = get_request_limits()
+    async with limits.image_sem:
+        await limits.image_limiter.acquire()
+        return await get_client().images.generate(**kwargs)
+
+def make_completion_request(prompt, tool=None, tools=None, system=None, **kwargs):
     if tool:
         kwargs["tools"] = [tool]
         kwargs["tool_choice"] = {"type": "function", "function": {"name": tool["function"]["name"]}}
         kwargs["response_format"] = {"type": "json_object"}
-    response = client.chat.completions.create(**{
+    if tools:
+        # let the model call several tools in one response
+        kwargs["tools"] = tools
+        kwargs["tool_choice"] = "required"
+    messages = [
+        {
+            "role": "user",
+            "content": prompt,
+        }
+    ]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    return {
         "model": "gpt-4-0125-preview",
         "max_tokens": 500,
-        "messages": [
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
+        "messages": messages,
         **kwargs,
-    })
+    }
+
+def parse_tool_arguments(arguments):
+    # almost always complete JSON, so try the fast parser before the forgiving one
+    try:
+        out = orjson.loads(arguments)
+    except orjson.JSONDecodeError:
+        out = partial_json_loads(arguments)
+    if out.keys() == {'items'}:
+        out = out['items']
+    return out
+
+def parse_completion(response, tool=None, tools=None, **kwargs):
     out_list = []
-    if tool:
+    if tools:
+        # one dict per choice, mapping tool name to its parsed arguments
+        for choice in response.choices:
+            out_list.append({
+                tool_call.function.name: parse_tool_arguments(tool_call.function.arguments)
+                for tool_call in choice.message.tool_calls or []
+            })
+    elif tool:
         for choice in response.choices:
-            out = partial_json_loads(choice.message.tool_calls[0].function.arguments)
-            if out.keys() == {'items'}:
-                out = out['items']
-            out_list.append(out)
+            out_list.append(parse_tool_arguments(choice.message.tool_calls[0].function.arguments))
     else:
         out_list = [choice.message.content for choice in response.choices]
     out = out_list if 'n' in kwargs else out_list[0]
     return out
 
 @cached
-def get_image(prompt):
-    response = client.images.generate(
+async def get_completion_text(prompt, tool=None, **kwargs):
+    response = await create_chat_completion(estimate_tokens(prompt, **kwargs), **make_completion_request(prompt, tool, **kwargs))
+    return parse_completion(response, tool, **kwargs)
+
+def make_batched_job(prompts, instructions, tool, todo, max_tokens_each=200, **kwargs):
+    batch_prompt = f"Process the following {len(todo)} chapters; return a JSON array of {len(todo)} results, one per chapter:\n\n"
+    batch_prompt += "\n\n".join(f"[CHAPTER {n}]\n{prompts[i]}" for n, i in enumerate(todo, 1))
+    batch_prompt += f"\n\nINSTRUCTIONS: {instructions}"
+    return {
+        'prompt': batch_prompt,
+        'tool': tool,
+        'max_tokens': max_tokens_each*len(todo),
+        **kwargs,
+    }
+
+async def get_completion_text_batched(prompts, instructions, tool, field, cache_keys, max_tokens_each=200, **kwargs):
+    """
+        Run the same instructions against several chapters in a single request. The tool must return a list of items
+        with a 'chapter' number and the result in `field`; each chapter's result is cached under its own cache key.
+    """
+    results = [get_cache(key) for key in cache_keys]
+    todo = [i for i, result in enumerate(results) if not result]
+    if not todo:
+        return results
+    items = await get_completion_text(**make_batched_job(prompts, instructions, tool, todo, max_tokens_each, **kwargs))
+    for item in items:
+        if type(item) is not dict or type(item.get('chapter')) is not int or not 1 <= item['chapter'] <= len(todo):
+            continue
+        result = item.get(field)
+        if not result:
+            continue
+        i = todo[item['chapter']-1]
+        results[i] = result
+        store_cache(cache_keys[i], result)
+    # chapters the model skipped come back as None and aren't cached, so they're retried next run
+    return results
+
+@cached
+async def fetch_and_compress_image(prompt):
+    response = await create_image(
         model="dall-e-3",
         prompt=prompt,
         # size="512x512",
@@ -171,122 +429,268 @@ def get_image(prompt):
         n=1,
         response_format="b64_json",
     )
-    return base64.b64decode(response.data[0].b64_json)
-
-@cached
-def compress_image(data):
-    # resize to 50%
-    img = Image.open(BytesIO(data))
-    resized = img.resize((768, 768), Image.LANCZOS)
+    # decode, resize to 50% and quantize to an 8-bit palette in one pass, so only the final PNG is cached
+    img = Image.open(BytesIO(base64.b64decode(response.data[0].b64_json)))
+    img = img.resize((768, 768), Image.LANCZOS).convert('P', palette=Image.Palette.ADAPTIVE, colors=128)
     output = BytesIO()
-    resized.save(output, format="PNG")
-    # compress
-    compression_ratio, data = pngquant.quant_data(output.getvalue())
-    return data
+    img.save(output, format="PNG", optimize=True)
+    return output.getvalue()
 
-### threads ###
+### batch api ###
 
-def run_threaded(func, jobs, max_workers=10):
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        return list(executor.map(lambda j: func(**j), jobs))
+async def run_batch_api(jobs, poll_interval=60):
+    """
+        Submit get_completion_text() jobs through the OpenAI Batch API and store the results in the cache,
+        so the realtime pipeline picks them up without making its own requests.
+    """
+    # key each job the same way @cached keys a get_completion_text(**job) call
+    jobs = [(make_cache_key('get_completion_text', (), job), job) for job in jobs]
+    jobs = [(cache_key, job) for cache_key, job in jobs if not get_cache(cache_key)]
+    if not jobs:
+        return
+    lines = []
+    for i, (cache_key, job) in enumerate(jobs):
+        lines.append(json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": make_completion_request(**job),
+        }))
+    client = get_client()
+    # remember the submitted batch under a key for this exact job list, so an interrupted run resumes polling it
+    # instead of paying for the same requests again; custom_ids are list indexes, so the order is part of the key
+    batch_key = make_cache_key('run_batch_api', tuple(cache_key for cache_key, job in jobs), {})
+    if batch_id := get_cache(batch_key):
+        batch = await call_openai(client.batches.retrieve, batch_id)
+        print(f"Resuming batch {batch.id}: {batch.status}")
+    else:
+        batch_file = await call_openai(client.files.create, file=('batch.jsonl', '\n'.join(lines).encode()), purpose="batch")
+        batch = await call_openai(client.batches.create, input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        store_cache(batch_key, batch.id)
+        print(f"Submitted batch {batch.id} with {len(jobs)} requests")
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        await asyncio.sleep(poll_interval)
+        batch = await call_openai(client.batches.retrieve, batch.id)
+        print(f"Batch {batch.id}: {batch.status} {batch.request_counts}")
+    if not batch.output_file_id:
+        print(f"Batch {batch.id} returned no results; falling back to realtime requests")
+        delete_cache(batch_key)
+        return
+    output = await call_openai(client.files.content, batch.output_file_id)
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        if not result['response'] or result['response']['status_code'] != 200:
+            continue
+        cache_key, job = jobs[int(result['custom_id'])]
+        response = ChatCompletion.model_validate(result['response']['body'])
+        request = {k: v for k, v in job.items() if k != 'prompt'}
+        store_cache(cache_key, parse_completion(response, **request))
+    # results are collected, so a later run with the same leftover jobs should submit a fresh batch
+    delete_cache(batch_key)
+
+### async ###
+
+async def run_async(func, jobs):
+    return await asyncio.gather(*[func(**j) for j in jobs])
+
+### prompts ###
+
+PRECIS_PROMPT = dedent("""
+    Write a very concise chapter precis or argument to go at the start of each of the above chapters, in the fashion of
+    a 19th century novel. Each precis should be a single sentence separated by semicolons, in abbreviated syntax rather
+    than full grammar and explanation. Be explicit rather than vague; for example, instead of saying "relationship
+    dynamics revealed," say what the dynamics are; instead of saying "setting the stage for future developments", say
+    what kind of developments might be expected. Do not leave out any major episodes of the chapter.
+    For example: "Introducing Mr. Smith, a resident of Whitehall; his interest in trains; a debate with Mr.
+    Jones regarding train design; ominous signs for their upcoming presentation."
+    Use a lighthearted or teasing tone that might tempt the reader into reading the next chapter.
+
+    Use the precis tool and return one result per chapter in json as {'chapter': number, 'precis': 'text'}.
+""").strip()
+
+COMMENTARY_PROMPT = dedent("""
+    Roleplay a short scene between the following commentary bots discussing the chapter:
+
+    * PoserBot likes to be taken very seriously about its deep insights about the text.
+    * SlackerBot didn't actually bother to read the chapter and is trying to pull out a line or two to comment on.
+    * SocialBot is hoping to get everyone psyched up about twists and turns in the book.
+    * PoetBot is an amateur poet who comments on any particularly lyrical passages.
+    * SassBot is a snarky critic who offers varied and incisive commentary.
+
+    The bots should be written wittily and precisely, like prestige TV characters.
+
+    Write a conversation with five or six total lines by these characters. Mix up the order they talk in.
+    Make sure to have the characters speak in short, natural sentences instead of paragraphs. 
+    NOT EVERYONE HAS TO TALK if they don't have something relevant, and a single character can talk more than once.
+
+    Use the dialog tool and return each line in json as {'speaker': 'name', 'line': 'text'}.
+""").strip()
+
+ANNOTATION_PROMPT = dedent("""
+    Provide a few officious annotations, in the same style as the original text, as by a Publisher who seeks to
+    sound knowing, sophisticated, well informed, and wry, but may be blustery or inadvertantly humorous.
+
+    Use the annotate tool and return each annotation in json as
+    {'text': 'verbatim text to annotate', 'annotation': 'footnote'}.
+""").strip()
+
+ADDITION_PROMPT = dedent("""
+    Propose five alternative additional sentences, in the style of the original, that could be added to improve the
+    text; only one will be used. Use the addition tool and return each sentence in json as
+    {'existing_sentence': 'text', 'new_sentence': 'text'}.
+""").strip()
+
+ILLUSTRATION_PROMPT = dedent("""
+    Extract and return one sentence from the chapter that could be illustrated by an engraving. Write a short 
+    description of an image that could illustrate the sentence in the context of the chapter. Describe a realistic
+    scene from the chapter rather than fantastical imagery.
+
+    Use the illustration tool and return the sentence and description in json as
+    {'existing_sentence': 'text', 'image_description': 'text'}.
+""").strip()
+
+CHAPTER_TASKS_PROMPT = "Complete all four of the following tasks, calling each tool once.\n\n" + "\n\n".join(
+    f"TASK {i}: {task}" for i, task in enumerate([COMMENTARY_PROMPT, ANNOTATION_PROMPT, ADDITION_PROMPT, ILLUSTRATION_PROMPT], 1)
+)
 
 ### main ###
 
-def process_chapter(chapter_path, title, author):
-    print("Processing", chapter_path)
-    out = {}
-    chapter_xml = chapter_path.read_bytes()
-    pq = parse_xml(chapter_xml)
-    section = pq('XHTML|section')
-    if not section:
-        return
-    text = section.text()
-    section_xml = re.search(r'<section.*?>(.*)</section>', chapter_xml.decode(), re.DOTALL).group(1)
-    whitespace = section[0].text if not(section[0].text.strip()) else ''
-
-    # run API queries
-    precis_prompt = dedent("""
-        Write a very concise chapter precis or argument to go at the start of the above chapter, in the fashion of a 19th
-        century novel. The precis should be a single sentence separated by semicolons, in abbreviated syntax rather than
-        full grammar and explanation. Be explicit rather than vague; for example, instead of saying "relationship dynamics
-        revealed," say what the dynamics are; instead of saying "setting the stage for future developments", say what kind
-        of developments might be expected. Do not leave out any major episodes of the chapter.
-        For example: "Introducing Mr. Smith, a resident of Whitehall; his interest in trains; a debate with Mr.
-        Jones regarding train design; ominous signs for their upcoming presentation."
-        Use a lighthearted or teasing tone that might tempt the reader into reading the next chapter.
-    """).strip()
-    commentary_prompt = dedent("""
-        Roleplay a short scene between the following commentary bots discussing the chapter:
-
-        * PoserBot likes to be taken very seriously about its deep insights about the text.
-        * SlackerBot didn't actually bother to read the chapter and is trying to pull out a line or two to comment on.
-        * SocialBot is hoping to get everyone psyched up about twists and turns in the book.
-        * PoetBot is an amateur poet who comments on any particularly lyrical passages.
-        * SassBot is a snarky critic who offers varied and incisive commentary.
-        
-        The bots should be written wittily and precisely, like prestige TV characters.
-        
-        Write a conversation with five or six total lines by these characters. Mix up the order they talk in.
-        Make sure to have the characters speak in short, natural sentences instead of paragraphs. 
-        NOT EVERYONE HAS TO TALK if they don't have something relevant, and a single character can talk more than once.
-        
-        Use the dialogue tool and return each line in json as {'speaker': 'name', 'line': 'text'}.
-    """).strip()
-    annotation_prompt = dedent("""
-        Provide a few officious annotations, in the same style as the original text, as by a Publisher who seeks to
-        sound knowing, sophisticated, well informed, and wry, but may be blustery or inadvertantly humorous.
-        
-        Use the annotate tool and return each annotation in json as
-        {'text': 'verbatim text to annotate', 'annotation': 'footnote'}.
-    """).strip()
-    addition_prompt = dedent("""
-        Propose one additional sentence, in the style of the original, that could be added to improve the text.
-        Use the addition tool and return the sentence in json as {'existing_sentence': 'text', 'new_sentence': 'text'}.
-    """).strip()
-    illustration_prompt = dedent("""
-        Extract and return one sentence from the chapter that could be illustrated by an engraving. Write a short 
-        description of an image that could illustrate the sentence in the context of the chapter. Describe a realistic
-        scene from the chapter rather than fantastical imagery.
-        
-        Use the illustration tool and return the sentence and description in json as
-        {'existing_sentence': 'text', 'image_description': 'text'}.
-    """).strip()
+def read_chapter_text(book, chapter_path):
+    section = SECTION_XPATH(read_xml(book, chapter_path)[0])
+    return PyQuery(section[0]).text() if section else None
 
+def get_chapter_job(chapter_path, text, title, author):
+    # the chapter goes in the system message once and all four tasks are answered by tool calls in a single response,
+    # rather than re-sending the whole chapter with each task
     prompt_prefix = f"The following is a chapter from {title} by {author}:\n\n{text}\n\nINSTRUCTIONS: "
-    prompts = [
-        {'prompt': prompt_prefix+precis_prompt, 'cache_key': f'precis_{chapter_path.stem}'},
-        {'prompt': prompt_prefix+commentary_prompt, 'cache_key': f'commentary11_{chapter_path.stem}', 'tool': dialogue_tool, 'temperature': 1.1},
-        {'prompt': prompt_prefix+annotation_prompt, 'cache_key': f'annotation19_{chapter_path.stem}', 'tool': annotate_tool, 'temperature': 1.2},
-        {'prompt': prompt_prefix+addition_prompt, 'cache_key': f'addition9_{chapter_path.stem}', 'tool': addition_tool, 'temperature': 1.4, 'n': 5},
-        {'prompt': prompt_prefix+illustration_prompt, 'cache_key': f'illustration5_{chapter_path.stem}', 'tool': illustration_tool},
+    system = prompt_prefix + CHAPTER_TASKS_PROMPT
+    return {
+        'prompt': "Run all four tasks.",
+        'system': system,
+        'tools': [dialogue_tool, annotate_tool, addition_tool, illustration_tool],
+        'temperature': 1.2,
+        'max_tokens': 2000,
+    }
+
+def get_summary_batches(chapters, title, author):
+    batches = [chapters[i:i+precis_batch_size] for i in range(0, len(chapters), precis_batch_size)]
+    instructions = f"The above chapters are from {title} by {author}. {PRECIS_PROMPT}"
+    return batches, [
+        {
+            'prompts': [text for path, text in batch],
+            'instructions': instructions,
+            'tool': precis_tool,
+            'field': 'precis',
+            # each chapter's precis is cached by its own text and instructions, independent of how it was batched
+            'cache_keys': [make_cache_key('precis', (instructions, text), {}) for path, text in batch],
+        }
+        for batch in batches
     ]
-    summary, commentary, annotations, additions, illustration = run_threaded(get_completion_text, prompts)
+
+async def get_summaries(chapters, title, author):
+    batches, jobs = get_summary_batches(chapters, title, author)
+    results = await run_async(get_completion_text_batched, jobs)
+    return {
+        path.stem: summary
+        for batch, batch_results in zip(batches, results)
+        for (path, text), summary in zip(batch, batch_results)
+    }
+
+async def get_illustration(book, chapter_path, illustration):
+    illustration_image_prompt = f"{illustration['image_description']}. Simple black and white engraving scanned from an old book with simple, clear lines. Crosshatching into white around the edges."
+    compressed_data = await fetch_and_compress_image(illustration_image_prompt)
+    illustration_path = chapter_path.parent.parent / f'images/illustration_{chapter_path.stem}.png'
+    book.write(illustration_path, compressed_data)
+    return illustration_path
+
+async def fetch_all_completions(book, chapter_path, text, title, author, summaries):
+    # run API queries
+    results = await get_completion_text(**get_chapter_job(chapter_path, text, title, author))
+    commentary = results.get('dialog', [])
+    annotations = results.get('annotate', [])
+    additions = results.get('addition', [])
+    illustration = results.get('illustration')
+
+    # illustration: start generating the image right away, and wait on it alongside the precis
+    illustration_task = None
+    if illustration and 'image_description' in illustration:
+        illustration_task = asyncio.create_task(get_illustration(book, chapter_path, illustration))
+
+    # precis for all chapters are fetched in shared batches; see get_summaries()
+    summary = (await summaries).get(chapter_path.stem)
+    illustration_path = await illustration_task if illustration_task else None
+
+    return {
+        'commentary': commentary,
+        'annotations': annotations,
+        'additions': additions,
+        'illustration': illustration,
+        'illustration_path': illustration_path,
+        'summary': summary,
+    }
+
+def tool_items(items, *fields):
+    # tool_choice="required" doesn't force any one schema, so keep only well-formed items from a list result
+    if type(items) is not list:
+        return []
+    return [item for item in items if type(item) is dict and all(field in item for field in fields)]
+
+def apply_annotations_to_xml(chapter_path, chapter_xml, results):
+    """
+        Pure XML work for one chapter, run in a worker process so chapters can be parsed and edited in parallel.
+        Takes and returns plain bytes/dicts so everything crossing the process boundary pickles cheaply.
+    """
+    pq = parse_xml(chapter_xml)
+    section_element = SECTION_XPATH(pq[0])[0]
+    section = PyQuery(section_element)
+    # serialize the already-parsed section and strip its outer tag, rather than regex-searching the raw file
+    section_xml = etree.tostring(section_element, encoding='unicode', method='xml', with_tail=False)
+    section_xml = section_xml.partition('>')[2].rpartition('</section>')[0]
+    whitespace = section_element.text if not(section_element.text.strip()) else ''
+    annotations = tool_items(results['annotations'], 'text', 'annotation')
+    additions = tool_items(results['additions'], 'existing_sentence', 'new_sentence')
+    illustration = results['illustration']
+    illustration_path = results['illustration_path']
 
     section_append = []
 
     ## raw text stuff
 
+    # edits are collected as (offset, markup) insertions against the original section_xml and spliced in at the end,
+    # so each one costs a single find() instead of a full-string replace()
+    insertions = []
+
     # annotations
     if annotations:
         footnote_number = 1
         for i, annotation in enumerate(annotations):
-            if not 'text' in annotation and 'annotation' in annotation:
-                continue
             text = annotation["text"].rstrip('.')  # removes occasional ellipsis
-            if text in section_xml:
+            offset = section_xml.find(text)
+            if offset != -1:
                 annotation["reader"] = "Publisher"
                 id = f'{chapter_path.stem}-note{i}'
-                section_xml = section_xml.replace(text, f'{text}<a class="noteref {annotation["reader"]}" epub:type="noteref" href="#{id}"><sup>{footnote_number}</sup></a>', 1)
+                insertions.append((offset + len(text), f'<a class="noteref {annotation["reader"]}" epub:type="noteref" href="#{id}"><sup>{footnote_number}</sup></a>'))
                 footnote_number += 1
                 section_append.append(f'{whitespace}<aside class="footnote" epub:type="footnote" id="{id}"><strong>{annotation["reader"]}:</strong> {annotation["annotation"]}</aside>')
 
     # extra sentence
     for addition in additions:
-        if addition['existing_sentence'] in section_xml:
-            section_xml = section_xml.replace(addition['existing_sentence'], f'{addition["existing_sentence"]} {addition["new_sentence"]}', 1)
+        offset = section_xml.find(addition['existing_sentence'])
+        if offset != -1:
+            insertions.append((offset + len(addition['existing_sentence']), f' {addition["new_sentence"]}'))
             section_append.append(f'{whitespace}<div class="ai-addition annotation-box">The Publisher regretted the necessity to add: {addition["new_sentence"]}</div>')
             break
 
+    # splice insertions in one pass; the sort is stable, so edits at the same offset keep their order
+    insertions.sort(key=lambda insertion: insertion[0])
+    parts = []
+    prev = 0
+    for offset, markup in insertions:
+        parts += [section_xml[prev:offset], markup]
+        prev = offset
+    parts.append(section_xml[prev:])
+    section_xml = ''.join(parts)
+
     # append raw text notes
     section.html(section_xml)
     for s in section_append:
@@ -295,47 +699,73 @@ def process_chapter(chapter_path, title, author):
     ## pyquery stuff
 
     # illustration
-    illustration_image_prompt = f"{illustration['image_description']}. Simple black and white engraving scanned from an old book with simple, clear lines. Crosshatching into white around the edges."
-    illustration_data = get_image(illustration_image_prompt, cache_key=illustration_image_prompt)
-    compressed_data = compress_image(illustration_data, cache_key=illustration_image_prompt+'compressed4')
-    illustration_path = chapter_path.parent.parent / f'images/illustration_{chapter_path.stem}.png'
-    illustration_path.write_bytes(compressed_data)
-    out['manifest'] = f'\n\t\t<item href="images/{illustration_path.name}" id="{illustration_path.name}" media-type="image/png"/>'
-    middle_paragraph = PyQuery(section('p')[len(section('p'))//2])
-    middle_paragraph.after(f'{whitespace}<div class="ai-illustration annotation-box">{whitespace}<img src="../images/{illustration_path.name}"/>{whitespace}<p><em>{illustration["existing_sentence"]}</em></p>{whitespace}</div>')
+    paragraphs = PARAGRAPH_XPATH(section_element)
+    if illustration_path and paragraphs:
+        middle_paragraph = PyQuery(paragraphs[len(paragraphs)//2])
+        middle_paragraph.after(f'{whitespace}<div class="ai-illustration annotation-box">{whitespace}<img src="../images/{illustration_path.name}"/>{whitespace}<p><em>{illustration.get("existing_sentence", "")}</em></p>{whitespace}</div>')
 
     # summary
-    summary = summary.strip('"')
-    section('header').after(f'{whitespace}<div class="ai-summary annotation-box">{summary}</div>')
+    if summary := results['summary']:
+        summary = summary.strip('"')
+        PyQuery(HEADER_XPATH(section_element)).after(f'{whitespace}<div class="ai-summary annotation-box">{summary}</div>')
 
     # pprint(commentary)
-    commentary = [c for c in commentary if type(c) is dict and 'speaker' in c and 'line' in c]
+    commentary = tool_items(results['commentary'], 'speaker', 'line')
     commentary = f'{whitespace}\t'.join(f'<p><strong class="{c["speaker"]}">{c["speaker"]}:</strong> {c["line"]}</p>' for c in commentary)
     section.append(f'{whitespace}<div class="ai-commentary annotation-box">{whitespace}\t{commentary}{whitespace}</div>')
 
-    write_xml(chapter_path, pq)
-    return out
+    return dump_xml(pq)
 
-def process_epub(epub_path, work_dir, output_epub):
-    unpack_epub(epub_path, work_dir)
+async def process_chapter(book, pool, chapter_path, text, title, author, summaries):
+    print("Processing", chapter_path)
+    results = await fetch_all_completions(book, chapter_path, text, title, author, summaries)
+    loop = asyncio.get_running_loop()
+    chapter_xml = await loop.run_in_executor(pool, apply_annotations_to_xml, chapter_path, book.read(chapter_path), results)
+    book.write(chapter_path, chapter_xml)
+    if not results['illustration_path']:
+        return {'manifest': ''}
+    illustration_name = results['illustration_path'].name
+    return {'manifest': f'\n\t\t<item href="images/{illustration_name}" id="{illustration_name}" media-type="image/png"/>'}
+
+async def prefetch_with_batch_api(chapters, title, author):
+    jobs = []
+    for path, text in chapters:
+        jobs.append(get_chapter_job(path, text, title, author))
+    for job in get_summary_batches(chapters, title, author)[1]:
+        todo = [i for i, key in enumerate(job['cache_keys']) if not get_cache(key)]
+        if todo:
+            jobs.append(make_batched_job(job['prompts'], job['instructions'], job['tool'], todo))
+    await run_batch_api(jobs)
+
+async def process_chapters(book, chapter_paths, title, author, batch=False):
+    chapters = [(path, text) for path in chapter_paths if (text := read_chapter_text(book, path))]
+    if batch:
+        # fill the cache via the Batch API first; images still go through the realtime API
+        await prefetch_with_batch_api(chapters, title, author)
+    # all chapters run in one event loop, so every prompt shares the same limits; see get_request_limits()
+    summaries = asyncio.create_task(get_summaries(chapters, title, author))
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        jobs = [
+           {'book': book, 'pool': pool, 'chapter_path': c, 'text': text, 'title': title, 'author': author, 'summaries': summaries}
+           for c, text in chapters
+        ]#[0:5]
+        return await run_async(process_chapter, jobs)
+
+def process_epub(epub_path, output_epub, batch=False):
+    book = ZipMutator(epub_path)
 
     # get author and title
-    metadata = read_xml(work_dir / 'epub/content.opf')
-    title = metadata('#title').text()
-    author = metadata('#author').text()
+    metadata = read_xml(book, 'epub/content.opf')
+    title = ID_XPATH(metadata[0], id='title')[0].text
+    author = ID_XPATH(metadata[0], id='author')[0].text
 
     # process chapters
-    chapter_paths = natsorted(work_dir.glob('epub/text/chapter-*.xhtml'))
-    jobs = [
-       {'chapter_path': c, 'title': title, 'author': author}
-       for i, c in enumerate(chapter_paths)
-    ]#[0:5]
-    chapter_results = run_threaded(process_chapter, jobs)
-    pack_epub(work_dir, output_epub)
+    chapter_paths = natsorted(book.glob('epub/text/chapter-*.xhtml'))
+    chapter_results = asyncio.run(process_chapters(book, chapter_paths, title, author, batch))
 
     # add css
-    css_path = work_dir / 'epub/css/local.css'
-    css = css_path.read_text()
+    css_path = 'epub/css/local.css'
+    css = book.read(css_path).decode('utf-8')
     css += """
         .annotation-box { 
             border: 2px black solid;
@@ -381,34 +811,39 @@ def process_epub(epub_path, work_dir, output_epub):
             }
         }
     """
-    css_path.write_text(css)
+    book.write(css_path, css)
 
     # add publisher's note
     # copy file
-    (work_dir / 'epub/text/publisher-note.xhtml').write_text((epub_path.parent / 'publisher-note.xhtml').read_text())
+    book.write('epub/text/publisher-note.xhtml', (epub_path.parent / 'publisher-note.xhtml').read_bytes())
     # add to content.opf
-    pq = read_xml(work_dir / 'epub/content.opf')
-    pq('OPF|manifest').prepend('\n\t\t<item id="publisher-note" href="text/publisher-note.xhtml" media-type="application/xhtml+xml"/>')
+    pq = read_xml(book, 'epub/content.opf')
+    manifest = PyQuery(MANIFEST_XPATH(pq[0]))
+    manifest.prepend('\n\t\t<item id="publisher-note" href="text/publisher-note.xhtml" media-type="application/xhtml+xml"/>')
     for chapter in chapter_results:
-        pq('OPF|manifest').append(chapter['manifest'])
-    pq('OPF|spine').prepend('\n\t\t<itemref idref="publisher-note"/>')
-    write_xml(work_dir / 'epub/content.opf', pq)
+        if chapter['manifest']:
+            manifest.append(chapter['manifest'])
+    PyQuery(SPINE_XPATH(pq[0])).prepend('\n\t\t<itemref idref="publisher-note"/>')
+    write_xml(book, 'epub/content.opf', pq)
     # add to toc.ncx
-    pq = read_xml(work_dir / 'epub/toc.ncx')
-    pq('#navmap').prepend('<navPoint id="publisher-note" playOrder="0"><navLabel><text>Publisher Note</text></navLabel><content src="text/publisher-note.xhtml"/></navPoint>')
-    write_xml(work_dir / 'epub/toc.ncx', pq)
+    pq = read_xml(book, 'epub/toc.ncx')
+    PyQuery(ID_XPATH(pq[0], id='navmap')).prepend('<navPoint id="publisher-note" playOrder="0"><navLabel><text>Publisher Note</text></navLabel><content src="text/publisher-note.xhtml"/></navPoint>')
+    write_xml(book, 'epub/toc.ncx', pq)
     # add to toc.xhtml
-    pq = read_xml(work_dir / 'epub/toc.xhtml')
-    pq('#toc > XHTML|ol').prepend('<li><a href="text/publisher-note.xhtml">Publisher Note</a></li>')
-    write_xml(work_dir / 'epub/toc.xhtml', pq)
+    pq = read_xml(book, 'epub/toc.xhtml')
+    PyQuery(TOC_LIST_XPATH(pq[0])).prepend('<li><a href="text/publisher-note.xhtml">Publisher Note</a></li>')
+    write_xml(book, 'epub/toc.xhtml', pq)
 
     # add cover image subtitle
-    img = Image.open(work_dir / 'epub/images/cover.jpg')
+    img = Image.open(BytesIO(book.read('epub/images/cover.jpg')))
     draw = ImageDraw.Draw(img)
-    draw.text((img.size[0]//2 + 100, img.size[1]-150), "Annotated & Improved", fill="white", font_size=64)
-    img.save(work_dir / 'epub/images/cover.jpg')
+    draw.text((img.size[0]//2 + 100, img.size[1]-150), "Annotated & Improved", fill="white", font=FONT)
+    output = BytesIO()
+    img.save(output, format="JPEG")
+    book.write('epub/images/cover.jpg', output.getvalue())
 
-    pack_epub(work_dir, output_epub)
+    book.save(output_epub)
+    book.close()
 
 # drop into pdb on any exception
 def excepthook(type, value, tb):
@@ -416,16 +851,22 @@ def excepthook(type, value, tb):
     import pdb
     traceback.print_exception(type, value, tb)
     pdb.pm()
-import sys
-sys.excepthook = excepthook
-
 
 
 if __name__ == '__main__':
+    import sys
+    sys.excepthook = excepthook
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', action='store_true', help="Run text prompts through the OpenAI Batch API (cheaper, but can take up to 24h)")
+    parser.add_argument('--unpack', action='store_true', help="Also unpack the input and output epubs into before/ and work_dir/ for diffing")
+    args = parser.parse_args()
+
     input_epub = base_dir / 'george-eliot_middlemarch.epub'
     output_epub = input_epub.with_name('annotated_' + input_epub.name)
-    work_dir = base_dir / 'work_dir'
-    before_dir = base_dir / 'before'
-    unpack_epub(input_epub, before_dir)
-    process_epub(input_epub, work_dir, output_epub)
+    process_epub(input_epub, output_epub, batch=args.batch)
+    if args.unpack:
+        # unpacked copies of the input and result, for diffing
+        unpack_epub(input_epub, base_dir / 'before')
+        unpack_epub(output_epub, base_dir / 'work_dir')
     print("Done!")
\ No newline at end of file